@@ -0,0 +1,88 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+__author__ = "Tobias Wiesner"
+__license__ = "GPL 3.0"
+__maintainer__ = "Tobias Wiesner"
+__email__ = "tobias@tawiesn.de"
+
+import sys
+import time
+from random import Random
+
+from PyQt5.QtCore import *
+from PyQt5.QtWidgets import *
+
+from ex_gui import ExerciseWindow,MyRegisterModel,SyntheticDevice,TraceReplayer
+
+def timeIt(label, function):
+  """ run function and print its runtime """
+  t0 = time.perf_counter()
+  res = function()
+  print("{0: <24}: {1:.4f} s".format(label, time.perf_counter() - t0))
+  return res
+
+def recordWorkload(model, numOps, seed):
+  """ record a random mix of register accesses on the model """
+  rng = Random(seed)
+  numRegisters = model.rowCount(None)
+  model.startRecording()
+  for k in range(0,numOps):
+    i = rng.randrange(numRegisters)
+    bi = model.getBitfields(i)[rng.randrange(model.getNumberOfBitfields(i))]
+    op = rng.randrange(4)
+    if op == 0:
+      model.getRegisterValue(i)
+    elif op == 1:
+      model.setRegisterValue(i, rng.getrandbits(8))
+    elif op == 2:
+      model.getRegisterSubValue(i, bi.pos, bi.width)
+    else:
+      model.setRegisterSubValue(i, bi.pos, bi.width, rng.getrandbits(bi.width))
+  return model.stopRecording()
+
+if __name__ == "__main__":
+  # usage: ex_benchmark.py [number of registers] [number of operations]
+  numRegisters = 100000
+  numOps = 100000
+  if len(sys.argv) > 1:
+    numRegisters = int(sys.argv[1])
+  if len(sys.argv) > 2:
+    numOps = int(sys.argv[2])
+
+  app = QApplication(sys.argv)
+  print("Synthetic device with {0} registers, {1} operations".format(numRegisters, numOps))
+
+  # model path
+  device = SyntheticDevice(numRegisters, seed = 1)
+  model = timeIt("load model", lambda: MyRegisterModel(device))
+  trace = timeIt("record workload", lambda: recordWorkload(model, numOps, 1))
+  replayer = TraceReplayer(trace, SyntheticDevice(numRegisters, seed = 1))
+  report = replayer.run()
+  print("replay                  : {0:.0f} ops/s (p50 {1:.2e} s, p99 {2:.2e} s, max {3:.2e} s)".format(
+    report["opsPerSec"], report["p50"], report["p99"], report["max"]))
+  print("replay load / flush     : {0:.4f} s / {1:.4f} s ({2} hardware accesses)".format(
+    report["loadSeconds"], report["flushSeconds"], report["hardwareOps"]))
+
+  # view path (shown window, including layout and painting)
+  form = ExerciseWindow()
+  def showView():
+    form.setModel(model)
+    form.show()
+    app.processEvents()
+  def selectRegisters(registers):
+    for i in registers:
+      form.changeRegisterSelection(i)
+      app.processEvents()
+  timeIt("create and show view", showView)
+  rng = Random(1)
+  registers = [rng.randrange(numRegisters) for k in range(0,100)]
+  timeIt("100 register selections", lambda: selectRegisters(registers))
+  print("generated register rows : {0}".format(device.numGenerated()))
+
+  # persistence path (store all register values and read them back)
+  mismatches = timeIt("verify before flush", model.verify)
+  timeIt("flush", model.flush)
+  timeIt("verify after flush", model.verify)
+  print("changed registers       : {0}".format(len(mismatches)))
+  timeIt("trace to bytes", trace.toBytes)
+  print("trace size              : {0} bytes".format(len(trace.toBytes())))
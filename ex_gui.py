@@ -8,7 +8,14 @@ __email__ = "tobias@tawiesn.de"
 
 import sys
 import os
-from random import randint
+import math
+import hashlib
+import time
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from random import randint, Random
+from collections import namedtuple
 from bitstring import BitArray
 
 from PyQt5.QtCore import *
@@ -19,29 +26,32 @@ from PyQt5.QtWidgets import *
   
 class HardwareLayerA:
   """ Hardware interface layer A """
-  my_data = [
-      ["reg 1", BitArray(int = 1, length=16), 
-        [
-        ["bit 0", 0, 1],
-        ["bits 1-7", 1, 7]
+
+  def __init__(self):
+    """ constructor: every instance (device) has its own register data """
+    self.my_data = [
+        ["reg 1", BitArray(int = 1, length=16), 
+          [
+          ["bit 0", 0, 1],
+          ["bits 1-7", 1, 7]
+          ],
+          BitArray('0b00000000')
         ],
-        BitArray('0b00000000')
-      ],
-      ["reg 2", BitArray(int = 2, length=16),
-        [
-        ["slider",0,8]
+        ["reg 2", BitArray(int = 2, length=16),
+          [
+          ["slider",0,8]
+          ],
+          BitArray('0b00000000')
         ],
-        BitArray('0b00000000')
-      ],
-      ["reg 3", BitArray(int = 3, length=16),
-        [
-        ["bit 0",0,1],
-        ["bit 1-3",1,3],
-        ["bit 4-8",4,4]    
+        ["reg 3", BitArray(int = 3, length=16),
+          [
+          ["bit 0",0,1],
+          ["bit 1-3",1,3],
+          ["bit 4-8",4,4]    
+          ],
+          BitArray('0b00000000')
         ],
-        BitArray('0b00000000')
-      ],
-      ]
+        ]
       
   def loadData(self):
     return self.my_data
@@ -55,21 +65,24 @@ class HardwareLayerA:
 
 class HardwareLayerB:  
   """ Hardware interface layer B """
-  my_data = [
-      ["reg 1", BitArray(int = 1, length=16), 
-        [
-        ["bit 0", 0, 1],
-        ["bits 1-7", 1, 7]
+
+  def __init__(self):
+    """ constructor: every instance (device) has its own register data """
+    self.my_data = [
+        ["reg 1", BitArray(int = 1, length=16), 
+          [
+          ["bit 0", 0, 1],
+          ["bits 1-7", 1, 7]
+          ],
+          BitArray('0b00000000')
         ],
-        BitArray('0b00000000')
-      ],
-      ["reg 2", BitArray(int = 2, length=16),
-        [
-        ["slider",0,8]
+        ["reg 2", BitArray(int = 2, length=16),
+          [
+          ["slider",0,8]
+          ],
+          BitArray('0b00000000')
         ],
-        BitArray('0b00000000')
-      ],
-      ]
+        ]
   
   def loadData(self):
     return self.my_data
@@ -80,34 +93,428 @@ class HardwareLayerB:
     print(data)
   
   
+#####################################################################
+
+BITFIELD_BUTTON = "button" # GUI element for bitfields of width 1
+BITFIELD_COMBO  = "combo"  # GUI element for bitfields of width 2-3
+BITFIELD_SLIDER = "slider" # GUI element for bitfields of width 4-8
+
+# single entry of a bitfield layout (mask is relative to the 8bit register value)
+Bitfield = namedtuple("Bitfield", ["name", "pos", "width", "mask", "kind"])
+
+# precomputed masks of all valid bitfields in an 8bit register value: (pos, width) -> mask
+BITFIELD_MASKS = {(pos, width): (pow(2,width)-1) << (8-pos-width) for pos in range(0,8) for width in range(1,9-pos)}
+
+def bitfieldMask(pos, width):
+  """ returns the mask of a bitfield relative to the 8bit register value """
+  mask = BITFIELD_MASKS.get((pos, width))
+  if mask is None:
+    raise RuntimeError("Error: inconsistent bitfield width {0} and position {1}".format(width, pos))
+  return mask
+
+def bitfieldWidgetKind(width):
+  """ returns the kind of GUI element used for a bitfield of the given width """
+  if width == 1:
+    return BITFIELD_BUTTON
+  elif width > 1 and width < 4:
+    return BITFIELD_COMBO
+  elif width > 3 and width < 9:
+    return BITFIELD_SLIDER
+  raise RuntimeError("Error: invalid bitfield width: {0}".format(width))
+
+class BitfieldLayout:
+  """ Immutable, validated bitfield layout shared by all registers with identical bitfields """
+
+  __registry = {}               # interned layouts
+  __lock     = threading.Lock() # layouts may be interned from DeviceSession worker threads
+
+  def __init__(self, fields):
+    """ constructor: validates a list of [name, pos, width] entries (use BitfieldLayout.intern) """
+    bitfields = []
+    usedBits = 0
+    sumBitfieldWidths = 0
+    for f in fields:
+      if len(f) != 3:
+        raise RuntimeError("Error: bitfield entry must consist of name, position and width")
+      name, pos, width = f
+      if isinstance(name, str) == False:
+        raise RuntimeError("Error: bitfield name must be of type string")
+      if isinstance(pos, int) == False or isinstance(width, int) == False:
+        raise RuntimeError("Error: bitfield position and width must be of type int")
+      if pos < 0 or pos > 7:
+        raise RuntimeError("Error: bitfield position must between 0 and 7")
+      kind = bitfieldWidgetKind(width)
+      if pos + width > 8:
+        raise RuntimeError("Error: inconsistent bitfield width and position")
+      mask = bitfieldMask(pos, width)
+      if usedBits & mask != 0:
+        raise RuntimeError("Error: bitfield '{0}' overlaps other bitfields".format(name))
+      usedBits = usedBits | mask
+      sumBitfieldWidths = sumBitfieldWidths + width
+      bitfields.append(Bitfield(name, pos, width, mask, kind))
+
+    if sumBitfieldWidths != 8:
+      raise RuntimeError("Error: sum of all bitfield widths should be 8 but is {0}".format(sumBitfieldWidths))
+
+    self.__fields = tuple(bitfields)
+
+  @classmethod
+  def intern(cls, fields):
+    """ returns the shared layout object for a list of [name, pos, width] entries """
+    if isinstance(fields, BitfieldLayout):
+      return fields
+    try:
+      key = tuple(tuple(f) for f in fields)
+      hash(key)
+    except TypeError:
+      raise RuntimeError("Error: bitfields must be a list of [name, pos, width] entries")
+    with cls.__lock:
+      layout = cls.__registry.get(key)
+      if layout is None:
+        layout = BitfieldLayout(key)
+        cls.__registry[key] = layout
+    return layout
+
+  def __len__(self):
+    return len(self.__fields)
+
+  def __getitem__(self, k):
+    return self.__fields[k]
+
+  def __iter__(self):
+    return iter(self.__fields)
+
+  def __repr__(self):
+    return repr(self.toList())
+
+  def toList(self):
+    """ returns the layout as list of [name, pos, width] entries (as used by the hardware layers) """
+    return [[f.name, f.pos, f.width] for f in self.__fields]
+
+def internBitfieldLayouts(devicedata):
+  """ 
+  validate the bitfields of all registers once 
+  
+  Returns the list of shared layout objects (one reference per register) or
+  None if the register rows already hold the shared layouts. The data of the
+  hardware layer is not modified.
+  """
+  if getattr(devicedata, "layoutsInterned", False) == True:
+    return None # e.g., SyntheticRegisters validate when generating a register
+  layouts = []
+  handedOver = True
+  for i in range(0,len(devicedata)):
+    bitfields = devicedata[i][2]
+    try:
+      layout = BitfieldLayout.intern(bitfields)
+    except RuntimeError as e:
+      raise RuntimeError("Error in register {0}: {1}".format(i, e))
+    handedOver = handedOver and layout is bitfields
+    layouts.append(layout)
+  if handedOver == True:
+    return None
+  return layouts
+
+def registerValues(devicedata):
+  """ returns the 8bit values of all registers as bytearray """
+  values = getattr(devicedata, "values", None)
+  if values is not None:
+    return values() # e.g., SyntheticRegisters
+  return bytearray(register[3].uint for register in devicedata)
+
+def createHardwareLayer(hardwarelayer):
+  """ factory-like selection of hardware layer by name (other objects are used as they are) """
+  if hardwarelayer == "HardwareLayerA":
+    return HardwareLayerA()
+  elif hardwarelayer == "HardwareLayerB":
+    return HardwareLayerB()
+  return hardwarelayer
+
+#####################################################################
+
+class SyntheticRegisters:
+  """ 
+  Register list (view) of a SyntheticDevice 
+  
+  Registers are generated on each access. Only registers that were written
+  are kept, so memory grows with the number of changed registers.
+  """
+
+  layoutsInterned = True # layouts are interned when a register is generated
+
+  def __init__(self, device):
+    """ constructor """
+    self.__device  = device
+    self.__changed = {} # written registers by index
+
+  def __len__(self):
+    return self.__device.numRegisters()
+
+  def __index(self, i):
+    if i < 0:
+      i = i + len(self)
+    if i < 0 or i >= len(self):
+      raise IndexError("Error: register index out of range")
+    return i
+
+  def __getitem__(self, i):
+    if isinstance(i, slice):
+      return [self[k] for k in range(*i.indices(len(self)))]
+    i = self.__index(i)
+    reg = self.__changed.get(i)
+    if reg is None:
+      reg = self.__device.generateRegister(i)
+    return reg
+
+  def __setitem__(self, i, register):
+    self.__changed[self.__index(i)] = register
+
+  def __iter__(self):
+    for i in range(0,len(self)):
+      yield self[i]
+
+  def numChanged(self):
+    """ returns the number of registers written through this view """
+    return len(self.__changed)
+
+  def values(self):
+    """ returns the 8bit values of all registers as bytearray """
+    values = bytearray(self.__device.values())
+    for i, register in self.__changed.items():
+      values[i] = register[3].uint
+    return values
+
+class SyntheticDevice:
+  """ 
+  Hardware interface layer generating registers lazily and deterministically from a seed 
+  
+  The register values are persisted in a bytearray: storeData writes the
+  values of all registers, loadData returns a new view reading them back.
+  """
+
+  def __init__(self, numRegisters = 1000, seed = 0, fieldCounts = None,
+               registerName = "reg {0}", bitfieldName = "bit {0}-{1}", addressWidth = None):
+    """ 
+    constructor 
+    
+    fieldCounts maps the number of bitfields per register (1-8) to relative
+    weights (default: all equally likely). registerName is formatted with the
+    register index, bitfieldName with the first and last bit of the bitfield.
+    addressWidth defaults to the smallest multiple of 4 bits (at least 16)
+    that holds all register addresses.
+    """
+    if numRegisters < 1:
+      raise RuntimeError("Error: synthetic device needs at least one register")
+    if fieldCounts is None:
+      fieldCounts = {1: 1, 2: 1, 3: 1, 4: 1, 5: 1, 6: 1, 7: 1, 8: 1}
+    for count, weight in fieldCounts.items():
+      if count < 1 or count > 8 or weight < 0:
+        raise RuntimeError("Error: invalid bitfield count distribution {0}".format(fieldCounts))
+    if sum(fieldCounts.values()) <= 0:
+      raise RuntimeError("Error: invalid bitfield count distribution {0}".format(fieldCounts))
+
+    bits = max(16, (numRegisters-1).bit_length())
+    if addressWidth is None:
+      addressWidth = 4 * int(math.ceil(bits / 4.0))
+    if addressWidth < (numRegisters-1).bit_length() or addressWidth % 4 != 0:
+      raise RuntimeError("Error: address width {0} does not fit {1} registers".format(addressWidth, numRegisters))
+
+    self.__numRegisters = numRegisters
+    self.__seed         = seed
+    self.__counts       = list(fieldCounts.keys())
+    self.__weights      = list(fieldCounts.values())
+    self.__registerName = registerName
+    self.__bitfieldName = bitfieldName
+    self.__addressWidth = addressWidth
+    self.__seedKey      = int.from_bytes(hashlib.sha256(str(seed).encode()).digest()[0:8], "little")
+    self.__values       = None # persisted register values (bytearray)
+    self.__numGenerated = 0
+
+  def numRegisters(self):
+    return self.__numRegisters
+
+  def numGenerated(self):
+    """ returns the number of register rows generated so far """
+    return self.__numGenerated
+
+  def __initialValue(self, i):
+    """ power-on value of register i (splitmix64 of seed and index) """
+    x = (self.__seedKey + (i+1) * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+    return (x ^ (x >> 31)) & 0xff
+
+  def values(self):
+    """ returns the persisted 8bit values of all registers (power-on values before the first store) """
+    if self.__values is None:
+      self.__values = bytearray(self.__initialValue(i) for i in range(0,self.__numRegisters))
+    return self.__values
+
+  def generateRegister(self, i):
+    """ generate register i (always the same for the same seed and persisted values) """
+    self.__numGenerated = self.__numGenerated + 1
+    rng = Random("{0}:{1}".format(self.__seed, i)) # independent of numRegisters and other seeds
+    count = rng.choices(self.__counts, weights = self.__weights)[0]
+
+    # split the 8 bits into count bitfields
+    bounds = [0] + sorted(rng.sample(range(1,8), count-1)) + [8]
+    bitfields = []
+    for k in range(0,count):
+      bitfields.append([self.__bitfieldName.format(bounds[k], bounds[k+1]-1), bounds[k], bounds[k+1]-bounds[k]])
+
+    register = []
+    register.append(self.__registerName.format(i))
+    register.append(BitArray(uint = i, length = self.__addressWidth))
+    register.append(BitfieldLayout.intern(bitfields))
+    if self.__values is None:
+      register.append(BitArray(uint = self.__initialValue(i), length = 8))
+    else:
+      register.append(BitArray(uint = self.__values[i], length = 8))
+    return register
+
+  def loadData(self):
+    return SyntheticRegisters(self)
+
+  def storeData(self, data):
+    values = registerValues(data)
+    if len(values) != self.__numRegisters:
+      raise RuntimeError("Error: synthetic device has {0} registers but data has {1}".format(self.__numRegisters, len(values)))
+    self.__values = values
+    print("Store data through synthetic device ({0} registers)".format(len(data)))
+
+#####################################################################
+
+TRACE_GET_VALUE    = 0 # getRegisterValue
+TRACE_SET_VALUE    = 1 # setRegisterValue
+TRACE_GET_SUBVALUE = 2 # getRegisterSubValue
+TRACE_SET_SUBVALUE = 3 # setRegisterSubValue
+
+class RegisterTrace:
+  """ Compact binary trace of register accesses recorded by MyRegisterModel """
+
+  __magic  = b"REGTRACE1"
+  # timestamp [s], operation, register index, bitfield position, bitfield width, value
+  __record = struct.Struct("<dBIBBH")
+
+  def __init__(self, data = b""):
+    """ constructor: optionally takes the binary records of an existing trace """
+    if len(data) % self.__record.size != 0:
+      raise RuntimeError("Error: trace data is truncated")
+    self.__data = bytearray(data)
+
+  def append(self, timestamp, op, i, pos, width, val):
+    """ append one register access """
+    self.__data += self.__record.pack(timestamp, op, i, pos, width, val)
+
+  def __len__(self):
+    return len(self.__data) // self.__record.size
+
+  def __iter__(self):
+    """ yields (timestamp, op, i, pos, width, val) tuples """
+    return self.__record.iter_unpack(bytes(self.__data))
+
+  def maxRegister(self):
+    """ returns the highest register index accessed in the trace (-1 for an empty trace) """
+    return max((i for (timestamp, op, i, pos, width, val) in self), default = -1)
+
+  def toBytes(self):
+    """ returns the trace in its binary file format """
+    return self.__magic + bytes(self.__data)
+
+  @classmethod
+  def fromBytes(cls, data):
+    """ creates a trace from its binary file format """
+    if data[:len(cls.__magic)] != cls.__magic:
+      raise RuntimeError("Error: data is not a register trace")
+    return cls(data[len(cls.__magic):])
+
+  def save(self, filename):
+    """ write trace to file """
+    with open(filename, "wb") as f:
+      f.write(self.toBytes())
+
+  @classmethod
+  def load(cls, filename):
+    """ read trace from file """
+    with open(filename, "rb") as f:
+      return cls.fromBytes(f.read())
+
 #####################################################################  
   
 class MyRegisterModel(QAbstractTableModel):
   """ Model class storing data """
   
   __devicedata = []
+  __layouts    = None # shared BitfieldLayout per register (None: stored in __devicedata)
+  __trace      = None # RegisterTrace while recording
+  __traceStart = 0.0  # start time of recording
+  __loaded     = False # data was loaded and validated
+  __closed     = False # data was written by close()
   
-  def __init__(self, hardwarelayer = 'HardwareLayerA', parent=None, *args):
-    """ Constructor with factory-like selection of hardware layer """
+  def __init__(self, hardwarelayer = 'HardwareLayerA', parent=None, *args, devicedata = None):
+    """ 
+    Constructor with factory-like selection of hardware layer 
+    
+    devicedata can be passed if it was already loaded from the hardware layer
+    (e.g., concurrently by DeviceSession).
+    """
     QAbstractTableModel.__init__(self, parent, *args)
 
-    self.hw = None    
-    if hardwarelayer == "HardwareLayerA":
-      self.hw = HardwareLayerA()
-      self.__devicedata = self.hw.loadData()
-    elif hardwarelayer == "HardwareLayerB":
-      self.hw = HardwareLayerB()
-      self.__devicedata = self.hw.loadData()
-    else:
-      self.hw = hardwarelayer
-      self.__devicedata = self.hw.loadData()
+    self.hw = createHardwareLayer(hardwarelayer)
+    if devicedata is None:
+      devicedata = self.hw.loadData()
+
+    # validate bitfield layouts at load time
+    self.__layouts = internBitfieldLayouts(devicedata)
+    self.__devicedata = devicedata
+    self.__loaded = True
+
+  def startRecording(self):
+    """ start recording all register get/set operations into a new RegisterTrace """
+    self.__trace = RegisterTrace()
+    self.__traceStart = time.perf_counter()
+
+  def stopRecording(self):
+    """ stop recording and return the recorded RegisterTrace """
+    trace = self.__trace
+    self.__trace = None
+    return trace
+
+  def isRecording(self):
+    return self.__trace is not None
+
+  def __record(self, op, i, pos, width, val):
+    """ append operation to trace (callers check that recording is active) """
+    self.__trace.append(time.perf_counter() - self.__traceStart, op, i, pos, width, val)
     
   def __del__(self):
-    """ destructor: write data to hardware layer """
+    """ destructor: write data to hardware layer (unless closed already or never loaded) """
+    if self.__loaded == False or self.__closed == True:
+      return
     print("Send data to hardware layer")
-    self.hw.storeData(self.__devicedata)
+    self.flush()
     print("Close connection")
 
+  def close(self, flush = True):
+    """ write data to hardware layer (unless flush == False); the destructor will not write it again """
+    self.__closed = True # also if storing fails: the destructor must not store again
+    if flush == True:
+      self.flush()
+
+  def flush(self):
+    """ write data to hardware layer """
+    self.hw.storeData(self.__devicedata)
+
+  def verify(self):
+    """ read data back from hardware layer and return indices of registers with differing values """
+    hwvalues = registerValues(self.hw.loadData())
+    values = registerValues(self.__devicedata)
+    if len(hwvalues) != len(values):
+      raise RuntimeError("Error: hardware layer has {0} registers but model has {1}".format(len(hwvalues), len(values)))
+    if hwvalues == values:
+      return []
+    return [i for i in range(0,len(values)) if hwvalues[i] != values[i]]
+
   def rowCount(self, parent):
     """ Needed for QAbstractTableModel """
     return len(self.__devicedata)
@@ -127,22 +534,43 @@ class MyRegisterModel(QAbstractTableModel):
   def getRegisterValue(self,i):
     """Get function """    
     """ returns the 8bit value in a BitString object """
+    dat = self.__registerValue(i)
+    if self.__trace is not None:
+      self.__record(TRACE_GET_VALUE, i, 0, 8, dat.uint)
+    return dat
+
+  def __registerValue(self,i):
+    """ returns the 8bit value in a BitString object (not recorded) """
     dat = self.data(self.createIndex(i,3),Qt.DisplayRole)
     if isinstance(dat, BitArray) == False:
       raise RuntimeError("Error: data is not a BitArray")
     if len(dat) != 8:
       raise RuntimeError("Error: data is not a BitArray of length 8")
-    return self.data(self.createIndex(i,3),Qt.DisplayRole)
+    return dat
 
   def getRegisterSubValue(self,i,pos,width):
     """Get function """    
     # get full value stored in model as a BitString
-    dataValue = self.getRegisterValue(i)
-    subValue = dataValue[pos:pos+width].uint
+    dataValue = self.__registerValue(i)
+    subValue = (dataValue.uint & bitfieldMask(pos, width)) >> (8-pos-width)
+    if self.__trace is not None:
+      self.__record(TRACE_GET_SUBVALUE, i, pos, width, subValue)
     return subValue
     
+  def notifyValuesChanged(self):
+    """ emit dataChanged for the values of all registers (e.g., after a DeviceSession broadcast) """
+    if len(self.__devicedata) > 0:
+      self.dataChanged.emit(self.createIndex(0,3), self.createIndex(len(self.__devicedata)-1,3))
+
+  def findRegister(self, name):
+    """ returns the index of the register with the given name """
+    for i in range(0,len(self.__devicedata)):
+      if self.__devicedata[i][0] == name:
+        return i
+    raise RuntimeError("Error: unknown register '{0}'".format(name))
+
   def getBitfields(self, i):
-    """Get function """    
+    """Get function (returns shared BitfieldLayout) """    
     return self.data(self.createIndex(i,2),Qt.DisplayRole)
 
   def getNumberOfBitfields(self, i):
@@ -152,19 +580,24 @@ class MyRegisterModel(QAbstractTableModel):
   def setRegisterValue(self, i, val):
     """ accepts an integer and stores it as 8bit BitArray object """
     bVal = BitArray(uint = val, length = 8)
-    return self.setData(self.createIndex(i,3),bVal)
+    ret = self.setData(self.createIndex(i,3),bVal)
+    if self.__trace is not None:
+      self.__record(TRACE_SET_VALUE, i, 0, 8, val)
+    return ret
     
   def setRegisterSubValue(self, i, pos, width, val):
     """ accepts an integer and stores it as subset of 8bit BitArray object """  
     # get full value stored in model as a BitString
-    dataValue = self.getRegisterValue(i)
+    dataValue = self.__registerValue(i)
+    mask = bitfieldMask(pos, width)
     
     if val < 0 or val > pow(2,width)-1:
       raise RuntimeError("ERROR: val = {0} conflicts with bit width {1}".format(val,width))
     
-    subValue = BitArray(uint=val, length=width)
-    dataValue[pos:pos+width] = subValue
-    self.setRegisterValue(i,dataValue.uint)
+    newValue = (dataValue.uint & ~mask & 0xff) | (val << (8-pos-width))
+    self.setData(self.createIndex(i,3),BitArray(uint = newValue, length = 8))
+    if self.__trace is not None:
+      self.__record(TRACE_SET_SUBVALUE, i, pos, width, val)
             
   def data(self, index, role):
     """ Data access routine in QAbstractTableModel class """
@@ -173,6 +606,10 @@ class MyRegisterModel(QAbstractTableModel):
     elif role != Qt.DisplayRole:
       return QVariant()
     
+    # bitfields: shared layout object
+    if index.column() == 2 and self.__layouts is not None:
+      return self.__layouts[index.row()]
+
     # default (e.g., for TableView)
     return self.__devicedata[index.row()][index.column()]
 
@@ -188,7 +625,9 @@ class MyRegisterModel(QAbstractTableModel):
       if isinstance(value, BitArray) == False:
         raise RuntimeError("ERROR: Register value must be of type BitArray")
 
-    self.__devicedata[index.row()][index.column()] = value
+    register = self.__devicedata[index.row()]
+    register[index.column()] = value
+    self.__devicedata[index.row()] = register # lazy register lists keep written registers only
     return True
   
   def flags(self, index):
@@ -196,6 +635,216 @@ class MyRegisterModel(QAbstractTableModel):
 
 #####################################################################
 
+def percentile(values, p):
+  """ nearest-rank percentile (0 < p <= 100) of a sorted list """
+  if len(values) == 0:
+    return 0.0
+  k = int(math.ceil(p * len(values) / 100.0))
+  return values[max(0, min(len(values), k) - 1)]
+
+class TraceReplayer:
+  """ 
+  Replays a RegisterTrace against a hardware layer and measures the register accesses 
+  
+  Each run loads the hardware layer into a new MyRegisterModel, replays the
+  operations and closes the model, which writes it back to the hardware layer. If the hardware
+  layer provides the optional per-register hooks readRegister(i) (returning the
+  8bit value as int) and writeRegister(i, value), every get operation reads the
+  register from the hardware layer and every set operation writes it. Otherwise
+  only loadData and storeData reach the hardware layer and the per-operation
+  latencies measure the model alone.
+  """
+
+  def __init__(self, trace, hardwarelayer = 'HardwareLayerA'):
+    """ constructor """
+    self.__trace = trace
+    self.__hw    = createHardwareLayer(hardwarelayer)
+    self.__model = None
+
+  def model(self):
+    """ returns the model of the last run (None before the first run) """
+    return self.__model
+
+  def run(self, realtime = False):
+    """ 
+    replay all operations of the trace 
+    
+    With realtime == True the recorded timing is reproduced, otherwise the
+    operations are executed as fast as possible. Returns a dictionary with the
+    number of operations, the time for loading, replaying and flushing,
+    operations per second and latency percentiles (in seconds) of the replayed
+    operations and the number of per-register hardware accesses.
+    """
+    hw = self.__hw
+    readRegister  = getattr(hw, "readRegister", None)
+    writeRegister = getattr(hw, "writeRegister", None)
+    hardwareOps = 0
+
+    t0 = time.perf_counter()
+    self.__model = MyRegisterModel(hw)
+    loadDuration = time.perf_counter() - t0
+
+    model = self.__model
+    maxRegister = self.__trace.maxRegister()
+    if maxRegister >= model.rowCount(None):
+      model.close(flush = False)
+      raise RuntimeError("Error: trace accesses register {0} but hardware layer has only {1} registers".format(maxRegister, model.rowCount(None)))
+    latencies = []
+    start = time.perf_counter()
+    for (timestamp, op, i, pos, width, val) in self.__trace:
+      if realtime == True:
+        delay = start + timestamp - time.perf_counter()
+        if delay > 0:
+          time.sleep(delay)
+
+      t0 = time.perf_counter()
+      if (op == TRACE_GET_VALUE or op == TRACE_GET_SUBVALUE) and readRegister is not None:
+        model.setRegisterValue(i, readRegister(i))
+        hardwareOps = hardwareOps + 1
+      if op == TRACE_GET_VALUE:
+        model.getRegisterValue(i)
+      elif op == TRACE_SET_VALUE:
+        model.setRegisterValue(i, val)
+      elif op == TRACE_GET_SUBVALUE:
+        model.getRegisterSubValue(i, pos, width)
+      elif op == TRACE_SET_SUBVALUE:
+        model.setRegisterSubValue(i, pos, width, val)
+      else:
+        raise RuntimeError("Error: unknown trace operation {0}".format(op))
+      if (op == TRACE_SET_VALUE or op == TRACE_SET_SUBVALUE) and writeRegister is not None:
+        writeRegister(i, model.getRegisterValue(i).uint)
+        hardwareOps = hardwareOps + 1
+      latencies.append(time.perf_counter() - t0)
+    duration = time.perf_counter() - start
+
+    t0 = time.perf_counter()
+    model.close()
+    flushDuration = time.perf_counter() - t0
+
+    latencies.sort()
+    report = {}
+    report["ops"]          = len(latencies)
+    report["hardwareOps"]  = hardwareOps
+    report["loadSeconds"]  = loadDuration
+    report["seconds"]      = duration
+    report["flushSeconds"] = flushDuration
+    report["totalSeconds"] = loadDuration + duration + flushDuration
+    report["opsPerSec"]    = len(latencies) / duration if duration > 0 else 0.0
+    report["p50"]          = percentile(latencies, 50)
+    report["p90"]          = percentile(latencies, 90)
+    report["p99"]          = percentile(latencies, 99)
+    report["max"]          = latencies[-1] if len(latencies) > 0 else 0.0
+    return report
+
+#####################################################################
+
+class DeviceSession:
+  """ 
+  Session with many devices, each with its own MyRegisterModel 
+  
+  Load, flush, verify and broadcast operations run concurrently on a thread 
+  pool. Errors are isolated per device: the result dictionaries returned by 
+  these operations map each device name to its result or to the exception 
+  raised for that device.
+
+  Session operations are not synchronized with edits through an ExerciseWindow
+  showing one of the models; the window is refreshed after a broadcast has
+  finished. Call session operations from the GUI thread.
+  """
+
+  def __init__(self, maxWorkers = None):
+    """ constructor: maxWorkers is the size of the thread pool """
+    self.__executor = ThreadPoolExecutor(max_workers = maxWorkers)
+    self.__models   = {} # device name -> MyRegisterModel
+
+  def __run(self, function, items):
+    """ run function for all (name, argument) items concurrently and collect results per name """
+    futures = {}
+    for name, arg in items.items():
+      futures[name] = self.__executor.submit(function, arg)
+    results = {}
+    for name, future in futures.items():
+      try:
+        results[name] = future.result()
+      except Exception as e:
+        results[name] = e
+    return results
+
+  def open(self, devices):
+    """ 
+    load devices concurrently 
+    
+    devices maps device names to hardware layers (or hardware layer names). 
+    Returns a dictionary mapping each name to its model or exception.
+    """
+    hws = {}
+    for name, hw in devices.items():
+      hws[name] = createHardwareLayer(hw)
+    
+    # hardware access and layout validation in worker threads
+    def load(hw):
+      data = hw.loadData()
+      internBitfieldLayouts(data)
+      return data
+    results = self.__run(load, hws)
+    
+    # models are created in the calling thread (Qt thread affinity)
+    for name, res in results.items():
+      if isinstance(res, Exception):
+        continue
+      try:
+        self.__models[name] = MyRegisterModel(hws[name], devicedata = res)
+        results[name] = self.__models[name]
+      except Exception as e:
+        results[name] = e
+    return results
+
+  def names(self):
+    """ returns the names of all successfully opened devices """
+    return list(self.__models.keys())
+
+  def model(self, name):
+    """ returns the model of a device """
+    return self.__models[name]
+
+  def flush(self):
+    """ write data of all devices to their hardware layers """
+    return self.__run(lambda model: model.flush(), self.__models)
+
+  def verify(self):
+    """ read back all devices; results are lists of registers with differing values """
+    return self.__run(lambda model: model.verify(), self.__models)
+
+  def broadcast(self, config, flush = True):
+    """ 
+    apply one register configuration to all devices in parallel 
+    
+    config maps register indices or register names to values.
+    """
+    def apply(model):
+      for reg, val in config.items():
+        i = reg
+        if isinstance(reg, str):
+          i = model.findRegister(reg)
+        model.setRegisterValue(i, val)
+      if flush == True:
+        model.flush()
+    results = self.__run(apply, self.__models)
+
+    # notify views in the calling thread
+    for model in self.__models.values():
+      model.notifyValuesChanged()
+    return results
+
+  def close(self):
+    """ close all devices (writes their data once) and release models and thread pool """
+    results = self.__run(lambda model: model.close(), self.__models)
+    self.__executor.shutdown()
+    self.__models = {}
+    return results
+
+#####################################################################
+
 class BitfieldWidget(QWidget):
   """ WidgetHandler for Bitfields """
   
@@ -203,6 +852,7 @@ class BitfieldWidget(QWidget):
   __reg   = -1   # number of register (selected in combobox)
   __pos   = -1   # position in 8bit register
   __width = 0    # bitfield width
+  __kind  = None # kind of GUI element (BITFIELD_BUTTON, BITFIELD_COMBO, BITFIELD_SLIDER)
   __act   = None # GUI element for bitfield
   
   def __init__(self, *args):
@@ -217,28 +867,36 @@ class BitfieldWidget(QWidget):
     """ return underlying model """
     return self.__model
 
-  def createWidget(self, register, pos, bitFieldWidth):
-    """ create widget for selected bitfield entry """
+  def createWidget(self, register, pos, bitFieldWidth, kind = None):
+    """ 
+    create widget for selected bitfield entry 
+    
+    kind is the precomputed GUI element kind of a validated BitfieldLayout entry.
+    Without it the bitfield is checked here.
+    """
     self.__reg   = register
     self.__pos   = pos
     self.__width = bitFieldWidth
 
-    if self.__pos < 0 or self.__pos > 7:
-      raise RuntimeError("Error: bitfield position must between 0 and 7")
-    if self.__pos + self.__width > 8:
-      raise RuntimeError("Error: inconsisten bitfield width and positiion")
+    if kind is None:
+      if self.__pos < 0 or self.__pos > 7:
+        raise RuntimeError("Error: bitfield position must between 0 and 7")
+      if self.__pos + self.__width > 8:
+        raise RuntimeError("Error: inconsisten bitfield width and positiion")
+      kind = bitfieldWidgetKind(bitFieldWidth)
+    self.__kind = kind
 
-    if bitFieldWidth == 1:
+    if kind == BITFIELD_BUTTON:
       self.__act = QPushButton(self)
       self.__act.setCheckable(True)
       self.__act.clicked.connect(self.slotBitfieldButtonChange)
-    elif bitFieldWidth < 4:
+    elif kind == BITFIELD_COMBO:
       self.__act = QComboBox(self)
       for k in range(0,pow(2,bitFieldWidth)):
         self.__act.addItem(str(k))
       self.__act.currentIndexChanged.connect(self.slotBitfieldComboChange)
         
-    elif bitFieldWidth < 9:
+    elif kind == BITFIELD_SLIDER:
       self.__act = QSlider(self)
       self.__act.setRange(0,pow(2,bitFieldWidth)-1)
       self.__act.setTickInterval(1)    
@@ -270,16 +928,16 @@ class BitfieldWidget(QWidget):
   def updateUI(self):
     """ update GUI elements for current bitfield with data from model """
     subValue = self.__model.getRegisterSubValue(self.__reg,self.__pos,self.__width)
-    if self.__width == 1:
+    if self.__kind == BITFIELD_BUTTON:
       if ((subValue == 1 and self.__act.isChecked() == False) or (subValue == 0 and self.__act.isChecked() == True)):
         self.__act.toggle()
       if self.__act.isChecked() == True:
         self.__act.setText("HIGH")
       else:
         self.__act.setText("LOW")
-    elif self.__width < 4:
+    elif self.__kind == BITFIELD_COMBO:
       self.__act.setCurrentIndex(subValue)
-    elif self.__width < 9:
+    elif self.__kind == BITFIELD_SLIDER:
       self.__act.setValue(subValue)
     else:
       raise RuntimeError("Error: bitfield width cannot exceed size 8")
@@ -344,21 +1002,41 @@ class BitfieldWidget(QWidget):
                 
 #####################################################################
 
+# models with more registers do not size the register selection by its items
+LARGE_MODEL_ROWS = 1000
+
 class ExerciseWindow(QWidget):
   """ Exercise MainWindow """
-  __model = None
+  __model             = None
+  __session           = None # DeviceSession (optional)
+  __cmbSelectDevice   = None
+  __cmbSelectRegister = None
+  __groupRegister     = None
   
   def __init__(self, *args):
     """ standard constructor """
     QWidget.__init__(self, *args)
          
   def setModel(self, model):
-    """ sets underlying model object and initializes GUI """
+    """ sets underlying model object and initializes GUI (switches model if already initialized) """
+    if self.__model is not None:
+      self.__model.dataChanged.disconnect(self.slotModelDataChanged)
     self.__model = model
+    self.__model.dataChanged.connect(self.slotModelDataChanged)
     
+    if self.__cmbSelectRegister is not None:
+      self.__cmbSelectRegister.blockSignals(True)
+      self.__cmbSelectRegister.setModel(self.__model)
+      self.__cmbSelectRegister.setCurrentIndex(0)
+      self.__cmbSelectRegister.blockSignals(False)
+      self.__adjustRegisterSelectionSize()
+      self.changeRegisterSelection(0)
+      return
+
     self.__cmbSelectRegister = QComboBox()
     self.__cmbSelectRegister.setModel(self.__model)
     self.__cmbSelectRegister.currentIndexChanged.connect(self.changeRegisterSelection)
+    self.__adjustRegisterSelectionSize()
     
     self.layout = QVBoxLayout(self)
     self.layout.addWidget(self.__cmbSelectRegister)
@@ -377,11 +1055,53 @@ class ExerciseWindow(QWidget):
     """ returns underlying model object """
     return self.__model
 
+  def __adjustRegisterSelectionSize(self):
+    """ size large register selections by a fixed text length instead of reading all register names """
+    if self.__model.rowCount(None) > LARGE_MODEL_ROWS:
+      self.__cmbSelectRegister.setMinimumContentsLength(20)
+      self.__cmbSelectRegister.setSizeAdjustPolicy(QComboBox.AdjustToMinimumContentsLengthWithIcon)
+    else:
+      self.__cmbSelectRegister.setMinimumContentsLength(0)
+      self.__cmbSelectRegister.setSizeAdjustPolicy(QComboBox.AdjustToContentsOnFirstShow)
+
+  def setSession(self, session):
+    """ sets a DeviceSession and adds a device selection to switch between its (loaded) models """
+    if len(session.names()) == 0:
+      raise RuntimeError("Error: session does not contain any devices")
+    self.__session = session
+    
+    self.setModel(session.model(session.names()[0]))
+    if self.__cmbSelectDevice is None:
+      self.__cmbSelectDevice = QComboBox()
+      self.__cmbSelectDevice.currentIndexChanged.connect(self.changeDeviceSelection)
+      self.layout.insertWidget(0, self.__cmbSelectDevice)
+    self.__cmbSelectDevice.blockSignals(True)
+    self.__cmbSelectDevice.clear()
+    self.__cmbSelectDevice.addItems(session.names())
+    self.__cmbSelectDevice.blockSignals(False)
+
+  def session(self):
+    """ returns DeviceSession object (or None) """
+    return self.__session
+
+  def slotModelDataChanged(self, topLeft, bottomRight):
+    """ slot for values changed outside the GUI (e.g., by a DeviceSession broadcast) """
+    i = self.__cmbSelectRegister.currentIndex()
+    if self.__groupRegister is not None and topLeft.row() <= i and i <= bottomRight.row():
+      self.updateUI()
+
+  def changeDeviceSelection(self, k):
+    """ slot function switching to the model of another device """
+    if k < 0:
+      return
+    self.setModel(self.__session.model(self.__session.names()[k]))
+
   def changeRegisterSelection(self, i):
     """ slot function switching to new register """
     print("Switch to register with index " + str(i+1) + "/" + str(self.__cmbSelectRegister.count()))
-    if self.layout.count() == 2:
-      self.layout.itemAt(1).widget().deleteLater()
+    if self.__groupRegister is not None:
+      self.layout.removeWidget(self.__groupRegister)
+      self.__groupRegister.deleteLater()
       
     layoutRegister = QVBoxLayout(self)
     
@@ -409,32 +1129,24 @@ class ExerciseWindow(QWidget):
     layoutRegisterValue.addWidget(self.__labelRegisterValue)
     layoutRegister.addLayout(layoutRegisterValue)
     
+    # bitfield layouts are validated when the model is loaded
     self.__actorBitfield = []
     cnt = 0
-    sumBitfieldWidths = 0
     for bi in self.__model.getBitfields(i):
       labelBitfieldName = QLabel()
-      labelBitfieldName.setText(bi[0])
+      labelBitfieldName.setText(bi.name)
       
-      position       = bi[1]
-      bitFieldWidth  = bi[2]      
       bitFieldWidget = BitfieldWidget(self)
       bitFieldWidget.setModel(self.__model)
 
       # add bitfield widgets
       layoutRegister.addWidget(labelBitfieldName)
-      layoutRegister.addWidget(bitFieldWidget.createWidget(i,position,bitFieldWidth))
+      layoutRegister.addWidget(bitFieldWidget.createWidget(i,bi.pos,bi.width,bi.kind))
 
       # store bitfield widget in list
       self.__actorBitfield.append(bitFieldWidget)
        
       cnt = cnt + 1 # index for bitfield actor objects
-      
-      # plausibility check
-      sumBitfieldWidths = sumBitfieldWidths + bitFieldWidth
-      
-    if sumBitfieldWidths != 8:
-      raise RuntimeError("Error: sum of all bitfield widths should be 8 but is {0}".format(sumBitfieldWidths))  
 
     self.__groupRegister = QGroupBox(self.tr("Register"))    
     self.__groupRegister.setLayout(layoutRegister)
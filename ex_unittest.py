@@ -7,6 +7,8 @@ __email__ = "tobias@tawiesn.de"
 
 
 import sys
+import gc
+import copy
 import unittest
 import itertools
 from bitstring import BitArray
@@ -15,7 +17,8 @@ from PyQt5.QtCore import *
 from PyQt5.QtWidgets import *
 from PyQt5.QtTest import QTest
 
-from ex_gui import ExerciseWindow,MyRegisterModel
+from ex_gui import ExerciseWindow,MyRegisterModel,BitfieldLayout,RegisterTrace,TraceReplayer,DeviceSession,SyntheticDevice
+from ex_gui import TRACE_GET_VALUE,TRACE_SET_VALUE,TRACE_GET_SUBVALUE,TRACE_SET_SUBVALUE
 
 app = QApplication(sys.argv)
 
@@ -95,8 +98,9 @@ class EightBitDemoDevice:
     self.my_data = deviceregisters
     
   def loadData(self):
-    # generate demo device and return it
-    self.build_8bit_demo_device()
+    # generate demo device (once) and return it
+    if hasattr(self, "my_data") == False:
+      self.build_8bit_demo_device()
     return self.my_data
     
   def storeData(self, data):
@@ -105,6 +109,42 @@ class EightBitDemoDevice:
     for i in range(0,len(self.my_data)):
       print("Register 0x{0: <4}: {1: <7} = 0b{2}".format(BitArray(int=i, length=16).hex,self.my_data[i][0],self.my_data[i][3].bin))
       
+class RegisterAccessDevice(EightBitDemoDevice):
+  """ 8bit demo device with per-register hooks which counts all hardware accesses """
+  def __init__(self):
+    self.calls = {"loadData": 0, "storeData": 0, "readRegister": 0, "writeRegister": 0}
+    self.values = {}
+
+  def loadData(self):
+    self.calls["loadData"] += 1
+    return EightBitDemoDevice.loadData(self)
+
+  def storeData(self, data):
+    self.calls["storeData"] += 1
+    self.my_data = data
+
+  def readRegister(self, i):
+    self.calls["readRegister"] += 1
+    return self.values.get(i, 0)
+
+  def writeRegister(self, i, value):
+    self.calls["writeRegister"] += 1
+    self.values[i] = value
+
+class CopyingDevice(EightBitDemoDevice):
+  """ 8bit demo device which keeps a separate copy of the data like real hardware """
+  def loadData(self):
+    return copy.deepcopy(EightBitDemoDevice.loadData(self))
+
+  def storeData(self, data):
+    self.my_data = copy.deepcopy(data)
+
+class FailingStoreDevice(RegisterAccessDevice):
+  """ 8bit demo device whose stores always fail """
+  def storeData(self, data):
+    self.calls["storeData"] += 1
+    raise OSError("bus error")
+
 class DefectDeviceA:  
   def loadData(self):
     data = [[42, BitArray(int = 1, length=16), # integer as a name
@@ -146,6 +186,31 @@ class DefectDeviceC:
   def storeData(self, data):
     print ("")        
   
+class DefectDeviceE:
+  """ valid first register, defect second register; records all stores """
+  def __init__(self):
+    self.stored = []
+    self.my_data = [["ok", BitArray(int = 1, length=16),
+        [
+        ["bits 0-7", 0, 8]
+        ],
+        BitArray('0b00000101')
+      ],
+      ["defect", BitArray(int = 2, length=16),
+        [
+        ["bit 0", 0, 1],
+        ["bits 1-7", 1, 22] # wrong bitfield width
+        ],
+        BitArray('0b00000000')
+      ]]
+
+  def loadData(self):
+    return self.my_data
+
+  def storeData(self, data):
+    self.stored.append(data)
+    self.my_data = data
+
 class DefectDeviceD:  
   def loadData(self):
     data = [["defect", BitArray(int = 1, length=16), 
@@ -175,9 +240,253 @@ class ExerciseTest(unittest.TestCase):
 
   def test_defectA(self):
     """ Test Defect devices """
-    for demodevice in {DefectDeviceA(),DefectDeviceB(),DefectDeviceC(),DefectDeviceD()}:
+    for demodevice in {DefectDeviceA(),DefectDeviceB(),DefectDeviceD()}:
       self.model = MyRegisterModel(demodevice)
       self.assertRaises(TypeError, self.form.testMe, self.model)
+
+  def test_defectLayout(self):
+    """ Test that defect bitfield layouts are rejected at load time """
+    self.assertRaises(RuntimeError, MyRegisterModel, DefectDeviceC())
+
+    # the data of a device that failed to load is never written back
+    device = DefectDeviceE()
+    self.assertRaises(RuntimeError, MyRegisterModel, device)
+    gc.collect()
+    self.assertEqual(device.stored, [])
+    self.assertEqual(len(device.my_data), 2)
+
+  def test_layouts(self):
+    """ Test interning and validation of bitfield layouts """
+    layoutA = BitfieldLayout.intern([["bit 0", 0, 1], ["bits 1-7", 1, 7]])
+    layoutB = BitfieldLayout.intern([["bit 0", 0, 1], ["bits 1-7", 1, 7]])
+    self.assertIs(layoutA, layoutB)
+    self.assertIs(BitfieldLayout.intern(layoutA), layoutA)
+    self.assertEqual(len(layoutA), 2)
+    self.assertEqual(layoutA[0].mask, 0b10000000)
+    self.assertEqual(layoutA[1].mask, 0b01111111)
+    self.assertEqual([bi.kind for bi in layoutA], ["button", "slider"])
+
+    # overlapping bitfields, gaps and invalid widths
+    self.assertRaises(RuntimeError, BitfieldLayout.intern, [["a", 0, 4], ["b", 2, 4]])
+    self.assertRaises(RuntimeError, BitfieldLayout.intern, [["a", 0, 4]])
+    self.assertRaises(RuntimeError, BitfieldLayout.intern, [["a", 0, 9]])
+
+    # registers with identical bitfields share one layout object
+    model = MyRegisterModel(EightBitDemoDevice())
+    other = EightBitDemoDevice().loadData()
+    self.assertIs(model.getBitfields(0), BitfieldLayout.intern(other[0][2]))
+
+    # sub-values are read and written through the bitfield masks
+    model.setRegisterValue(0, 0b10110100)
+    self.assertEqual(model.getRegisterSubValue(0, 2, 3), 0b110)
+    model.setRegisterSubValue(0, 2, 3, 0b001)
+    self.assertEqual(model.getRegisterValue(0).uint, 0b10001100)
+    self.assertRaises(RuntimeError, model.getRegisterSubValue, 0, 6, 3)
+
+  def test_layoutsHardwareData(self):
+    """ Test that the hardware layer keeps and receives plain bitfield lists """
+    device = EightBitDemoDevice()
+    model = MyRegisterModel(device)
+    self.assertIsInstance(device.my_data[0][2], list)
+    model.flush()
+    self.assertIsInstance(device.my_data[0][2], list)
+    self.assertEqual(device.my_data[0][2], model.getBitfields(0).toList())
+
+    # hardware layers may hand over shared layouts themselves
+    for register in device.my_data:
+      register[2] = BitfieldLayout.intern(register[2])
+    model = MyRegisterModel(device)
+    self.assertIs(model.getBitfields(7), device.my_data[7][2])
+
+  def test_recordReplay(self):
+    """ Test recording and replay of register access traces """
+    model = MyRegisterModel(EightBitDemoDevice())
+    model.startRecording()
+    model.setRegisterValue(3, 0xa5)
+    model.getRegisterValue(3)
+    model.setRegisterSubValue(3, 0, 1, 0)
+    self.assertEqual(model.getRegisterSubValue(3, 0, 1), 0)
+    trace = model.stopRecording()
+    self.assertFalse(model.isRecording())
+    self.assertEqual(len(trace), 4)
+
+    # sub-value operations are recorded as single operations
+    ops = [op for (timestamp, op, i, pos, width, val) in trace]
+    self.assertEqual(ops, [TRACE_SET_VALUE, TRACE_GET_VALUE, TRACE_SET_SUBVALUE, TRACE_GET_SUBVALUE])
+    self.assertEqual(trace.maxRegister(), 3)
+
+    # binary round trip
+    trace = RegisterTrace.fromBytes(trace.toBytes())
+    self.assertEqual(len(trace), 4)
+
+    replayer = TraceReplayer(trace, EightBitDemoDevice())
+    report = replayer.run()
+    self.assertEqual(report["ops"], 4)
+    self.assertEqual(report["hardwareOps"], 0)
+    self.assertTrue(report["p50"] <= report["p99"] <= report["max"])
+    self.assertEqual(replayer.model().getRegisterValue(3).uint, 0x25)
+
+    # load, per-register hooks and flush reach the hardware layer
+    device = RegisterAccessDevice()
+    report = TraceReplayer(trace, device).run()
+    self.assertEqual(report["hardwareOps"], 4)
+    self.assertEqual(device.calls["loadData"], 1)
+    self.assertEqual(device.calls["storeData"], 1)
+    self.assertEqual(device.calls["readRegister"], 2)
+    self.assertEqual(device.calls["writeRegister"], 2)
+    self.assertEqual(device.values[3], 0x25)
+    self.assertTrue(report["totalSeconds"] >= report["loadSeconds"] + report["flushSeconds"])
+
+    # trace must fit the target hardware layer; its data is not written back
+    model = MyRegisterModel(EightBitDemoDevice())
+    model.startRecording()
+    model.getRegisterValue(100)
+    device = RegisterAccessDevice()
+    device.my_data = EightBitDemoDevice().loadData()[0:3]
+    self.assertRaises(RuntimeError, TraceReplayer(model.stopRecording(), device).run)
+    gc.collect()
+    self.assertEqual(device.calls["storeData"], 0)
+
+  def test_session(self):
+    """ Test multi-device session with concurrent I/O """
+    session = DeviceSession(4)
+    devices = {}
+    for k in range(0,3):
+      devices["board {0}".format(k)] = EightBitDemoDevice()
+    devices["defect"] = DefectDeviceC()
+    results = session.open(devices)
+
+    # defect device is isolated from the others
+    self.assertIsInstance(results["defect"], RuntimeError)
+    self.assertEqual(session.names(), ["board 0", "board 1", "board 2"])
+
+    results = session.broadcast({0: 0x0f, "reg 1": 0xf0})
+    for name in session.names():
+      self.assertIsNone(results[name])
+      self.assertEqual(session.model(name).getRegisterValue(0).uint, 0x0f)
+      self.assertEqual(session.model(name).getRegisterValue(1).uint, 0xf0)
+    self.assertEqual(session.verify(), {"board 0": [], "board 1": [], "board 2": []})
+
+    # broadcast refreshes the GUI showing one of the devices
+    self.form.setSession(session)
+    session.broadcast({0: 0x3c})
+    self.assertEqual(self.form._ExerciseWindow__labelRegisterValue.value(), 0x3c)
+
+    # unknown register names fail per device
+    results = session.broadcast({"no such register": 1})
+    self.assertIsInstance(results["board 0"], RuntimeError)
+
+    # switch devices in the GUI without reloading
+    self.assertIs(self.form.model(), session.model("board 0"))
+    self.form.changeDeviceSelection(2)
+    self.assertIs(self.form.model(), session.model("board 2"))
+    session.close()
+
+  def test_sessionVerify(self):
+    """ Test read back of devices which keep a separate copy of the data """
+    session = DeviceSession(2)
+    session.open({"a": CopyingDevice(), "b": CopyingDevice()})
+    self.assertEqual(session.verify(), {"a": [], "b": []})
+
+    # unflushed changes are detected
+    session.model("a").setRegisterValue(5, 0x42)
+    self.assertEqual(session.verify(), {"a": [5], "b": []})
+    self.assertEqual(session.flush(), {"a": None, "b": None})
+    self.assertEqual(session.verify(), {"a": [], "b": []})
+    session.close()
+
+  def test_sessionIdenticalBoards(self):
+    """ Test that boards of the same hardware layer do not share data """
+    session = DeviceSession(2)
+    session.open({"a": "HardwareLayerA", "b": "HardwareLayerA"})
+    session.model("a").setRegisterValue(0, 0x55)
+    self.assertEqual(session.model("a").getRegisterValue(0).uint, 0x55)
+    self.assertEqual(session.model("b").getRegisterValue(0).uint, 0)
+    session.close()
+
+  def test_sessionClose(self):
+    """ Test that closing a session stores the data of every device once """
+    device = RegisterAccessDevice()
+    session = DeviceSession(2)
+    session.open({"a": device})
+    session.close()
+    del session
+    gc.collect()
+    self.assertEqual(device.calls["storeData"], 1)
+
+    # a failing store is reported per device and not retried by the destructor
+    device = FailingStoreDevice()
+    session = DeviceSession(2)
+    session.open({"a": device})
+    results = session.close()
+    self.assertIsInstance(results["a"], OSError)
+    del session
+    gc.collect()
+    self.assertEqual(device.calls["storeData"], 1)
+
+  def test_synthetic(self):
+    """ Test lazily generated synthetic devices """
+    device = SyntheticDevice(1000000, seed = 7)
+    model = MyRegisterModel(device)
+    self.assertEqual(model.rowCount(None), 1000000)
+    self.assertEqual(model.getRegisterName(999999), "reg 999999")
+    self.assertEqual(model.getRegisterAddress(999999).uint, 999999)
+    self.assertTrue(device.numGenerated() < 10)
+
+    # same seed generates the same registers
+    other = SyntheticDevice(1000000, seed = 7).loadData()
+    for i in [0, 12345, 999999]:
+      self.assertEqual(other[i][0], model.getRegisterName(i))
+      self.assertIs(other[i][2], model.getBitfields(i))
+      self.assertEqual(other[i][3], model.getRegisterValue(i))
+
+    # configurable bitfield count and names
+    device = SyntheticDevice(1000, seed = 3, fieldCounts = {2: 1}, registerName = "r{0}", bitfieldName = "f{0}")
+    model = MyRegisterModel(device)
+    for i in range(0,1000):
+      self.assertEqual(model.getNumberOfBitfields(i), 2)
+    self.assertEqual(model.getRegisterName(5), "r5")
+    self.assertRaises(RuntimeError, SyntheticDevice, 10, fieldCounts = {9: 1})
+
+    # registers do not depend on the number of registers, seeds are independent
+    small = SyntheticDevice(1000, seed = 5).loadData()
+    large = SyntheticDevice(2000, seed = 5).loadData()
+    self.assertEqual(small[10][3], large[10][3])
+    self.assertIs(small[10][2], large[10][2])
+    shifted = SyntheticDevice(2000, seed = 4).loadData()
+    self.assertNotEqual([(r[2], r[3].uint) for r in small[0:100]],
+                        [(r[2], r[3].uint) for r in shifted[1000:1100]])
+
+    # unchanged registers are regenerated instead of cached
+    device = SyntheticDevice(1000, seed = 2)
+    data = device.loadData()
+    for register in data:
+      pass
+    self.assertEqual(data.numChanged(), 0)
+
+    # values are persisted by storeData and read back through a new view
+    persisted = MyRegisterModel(device)
+    value = persisted.getRegisterValue(3).uint ^ 0xff
+    persisted.setRegisterValue(3, value)
+    self.assertEqual(persisted.getRegisterValue(3).uint, value)
+    self.assertEqual(persisted.verify(), [3])
+    persisted.flush()
+    self.assertEqual(persisted.verify(), [])
+    self.assertEqual(device.loadData()[3][3].uint, value)
+    self.assertEqual(MyRegisterModel(device).getRegisterValue(3).uint, value)
+
+    # showing the view does not generate all registers
+    device = SyntheticDevice(100000, seed = 1)
+    form = ExerciseWindow()
+    form.setModel(MyRegisterModel(device))
+    form.show()
+    app.processEvents()
+    self.assertTrue(device.numGenerated() < 100)
+    form.close()
+
+    self.form.setModel(model)
+    self.form.changeRegisterSelection(999)
+    self.assertEqual(self.form.model().getRegisterName(999), "r999")
         
 if __name__ == "__main__":
   unittest.main()